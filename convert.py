@@ -1,6 +1,13 @@
 #!/usr/bin/python3
 
+import argparse
+import collections
+import functools
+import hashlib
+import json
 import logging
+import math
+import os
 import re
 import sys
 
@@ -101,6 +108,67 @@ pattern_info_chord = re.compile(f"(?P<chord>{pattern_chord_full}): {pattern_info
 
 infobreak = " \\\\"
 
+# transposition
+note_values = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11, "H": 11}
+accidental_values = {"": 0, "#": 1, "b": -1}
+notes_sharp = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+notes_flat = ["C", "Db", "D", "Eb", "E", "F", "Gb", "G", "Ab", "A", "Bb", "B"]
+
+# german notation (H = B, B = Bb), used when a song contains an H chord
+note_values_german = {**note_values, "B": 10, "H": 11}
+notes_sharp_german = notes_sharp[:11] + ["H"]
+notes_flat_german = notes_flat[:10] + ["B", "H"]
+
+# chord root (at the start, optionally after a bracket) or bass note (after a slash)
+pattern_transpose_note = re.compile(r"(?P<prefix>^\(?|/)(?P<note>[A-Ha-h])(?P<accidental>[#b]?)")
+
+# chord commands in converted lines, with the chord description of info parts
+pattern_transpose_chord = re.compile(r"(?P<command>\\(?:write)?chord\*?)\{(?P<chord>[^{}]*)\}(?P<description>: (?:\{--\}|[0-9]){6})?")
+pattern_transpose_fret = re.compile(r"\{--\}|[0-9]")
+pattern_transpose_german = re.compile(r"(?:^\(?|/)[Hh]")
+
+# root of the first chord, giving the key used to choose between sharps and flats
+pattern_transpose_key = re.compile(r"\(?(?P<note>[A-Ha-h])(?P<accidental>[#b]?)(?P<minor>m(?!aj))?")
+flat_keys_major = {5, 10, 3, 8, 1}  # F, Bb, Eb, Ab, Db
+flat_keys_minor = {2, 7, 0, 5, 10, 3}  # Dm, Gm, Cm, Fm, Bbm, Ebm
+
+# page layout estimation
+# heights are given in baselines of the main font, adjust them to the songbook layout (--layout-metrics)
+layout_metrics = {
+    "page_height": 58.0,
+    "chars_per_line": 85,
+    "song_title": 3.0,
+    "song_skip": 2.0,
+    "part_skip": 1.0,
+    "text_line": 1.0,
+    "chord_line": 0.8,
+    "info_line": 0.9,
+    "tab_line": 0.55,
+    # False when \versebreak doesn't start a new line (e.g. '/ ')
+    "versebreak_newline": True,
+}
+
+# commands (with optional and mandatory argument) that don't take up space in the text line
+pattern_layout_command = re.compile(r"\\[a-zA-Z]+\*?(?:\[[^]]*\])?(?:\{[^{}]*\})?")
+
+# characters replaced in filenames used with \include (spaces, commas separating \includeonly names, TeX special characters)
+pattern_include_name = re.compile(r"[\s,%#{}~^\\&$]+")
+
+# chord brackets and appendix ignored in statistics ("(Em)", "Em*")
+pattern_stats_chord_strip = re.compile(r"^\(|\)$|\*+\)?$")
+
+# "no chord" markings, not counted as chords in statistics
+pattern_stats_chord_no = re.compile(pattern_chord_no)
+
+# intermediate representation of converted songs, increase when the parsing / conversion changes
+ir_version = 1
+
+# statistics kept in the cache folder, increase when the collected statistics change
+stats_version = 1
+
+# settings applied during conversion, stored in the converted lines of the intermediate representation
+ir_settings = [translate_text, translate_chords, translate_bars, tab_cell_unit, tab_rule_format, tab_note_format, tab_other_format]
+
 
 def basename(filename: str) -> str:
     return Path(filename).stem
@@ -110,8 +178,95 @@ def multi_replace(text: str, pattern: re.Pattern, replacements: dict[str, str]):
     return pattern.sub(lambda x: replacements[x.group(0)], text)
 
 
+def text_width(line: str) -> int:
+    return len(pattern_layout_command.sub("", line).strip())
+
+
+def text_rows(width: int, metrics: dict) -> int:
+    return max(1, math.ceil(width / metrics["chars_per_line"]))
+
+
+def transposition_label(semitones: int) -> str:
+    return f"{semitones:+d}"
+
+
+@functools.lru_cache(maxsize=None)
+def transpose_chord(chord: str, semitones: int, german: bool = False, flats: bool = False) -> str:
+    values = note_values_german if german else note_values
+    names = (notes_flat_german if flats else notes_sharp_german) if german else (notes_flat if flats else notes_sharp)
+
+    def transpose_note(m: re.Match) -> str:
+        note = names[(values[m.group("note").upper()] + accidental_values[m.group("accidental")] + semitones) % 12]
+
+        return m.group("prefix") + (note.lower() if m.group("note").islower() else note)
+
+    return pattern_transpose_note.sub(transpose_note, chord)
+
+
+@functools.lru_cache(maxsize=None)
+def transpose_chord_description(description: str, semitones: int) -> str | None:
+    frets = pattern_transpose_fret.findall(description)
+
+    # move the shape up or down the neck, as long as all frets stay single-digit
+    for shift in (semitones % 12, semitones % 12 - 12):
+        if all(fret == "{--}" or 0 <= int(fret) + shift <= 9 for fret in frets):
+            return "".join(fret if fret == "{--}" else str(int(fret) + shift) for fret in frets)
+
+    return None
+
+
+def transposed_key_flats(chords: list[str], semitones: int, german: bool = False) -> bool:
+    values = note_values_german if german else note_values
+
+    # the first chord gives the key, spell all chords with the accidentals of the transposed key
+    for chord in chords:
+        if m := pattern_transpose_key.match(chord):
+            key = (values[m.group("note").upper()] + accidental_values[m.group("accidental")] + semitones) % 12
+            return key in (flat_keys_minor if m.group("minor") else flat_keys_major)
+
+    return semitones < 0
+
+
+def transpose_lines(lines: list[str], semitones: int, tab_ranges: list[tuple[int, int]] | None = None) -> list[str]:
+    if semitones % 12 == 0:
+        return lines
+
+    # source lines (comments) and tab parts (the fingering can't be transposed) are kept as they are
+    tab = {i for start, end in tab_ranges or [] for i in range(start, end)}
+    converted = [i for i, line in enumerate(lines) if i not in tab and not line.startswith("%")]
+    chords = [m.group("chord") for i in converted for m in pattern_transpose_chord.finditer(lines[i])]
+
+    # a song using H is written in german notation
+    german = any(pattern_transpose_german.search(chord) for chord in chords)
+    flats = transposed_key_flats(chords, semitones, german)
+
+    def transpose_command(m: re.Match) -> str:
+        chord = transpose_chord(m.group("chord"), semitones, german, flats)
+
+        if m.group("description") is None:
+            return "{}{{{}}}".format(m.group("command"), chord)
+
+        if (description := transpose_chord_description(m.group("description")[2:], semitones)) is None:
+            # keep the chord in the new key, but drop the shape that doesn't fit
+            logging.warning("can't transpose chord description '{}' by {}, dropping it".format(m.group(0), transposition_label(semitones)))
+            return "{}{{{}}}".format(m.group("command"), chord)
+
+        return "{}{{{}}}: {}".format(m.group("command"), chord, description)
+
+    result = lines.copy()
+    for i in converted:
+        result[i] = pattern_transpose_chord.sub(transpose_command, lines[i])
+
+    return result
+
+
 class chordsheet_line(str):
-    def __init__(self, line: str):
+    def __new__(cls, line: str, number: int | None = None):
+        return super().__new__(cls, line)
+
+    def __init__(self, line: str, number: int | None = None):
+        # line number in the input file (None for lines created during conversion)
+        self.number = number
         self.type = self.get_type(line)
 
     def get_type(self, line: str) -> str:
@@ -163,6 +318,24 @@ class chordsheet_line(str):
         else:
             return False
 
+    def to_ir(self) -> list:
+        if self.type == "chords":
+            return [str(self), self.number, self.type, self.word_list]
+
+        return [str(self), self.number, self.type]
+
+    @classmethod
+    def from_ir(cls, data: list) -> "chordsheet_line":
+        # restore without classifying the line again
+        line = str.__new__(cls, data[0])
+        line.number = data[1]
+        line.type = data[2]
+
+        if line.type == "chords":
+            line.word_list = [tuple(word) for word in data[3]]
+
+        return line
+
 
 class leadsheet_lines:
     def __init__(self, lines: list[str], rep: int = 1):
@@ -187,6 +360,13 @@ class leadsheet_lines:
 
         raise NotImplemented
 
+    def to_ir(self) -> list:
+        return [self.lines, self.rep]
+
+    @classmethod
+    def from_ir(cls, data: list) -> "leadsheet_lines":
+        return cls(data[0], data[1])
+
     def export(self) -> list[str]:
         if self.rep == 0:
             return []
@@ -212,6 +392,12 @@ class song:
         self.metadata_src: list[chordsheet_line] = []
         self.song_parts: list[song_part] = []
 
+        # output line ranges with their input line ranges, filled by export()
+        self.source_map: list[dict[str, list]] = []
+
+        # output line ranges of tab parts, which are kept in the original key on transposition
+        self.tab_ranges: list[tuple[int, int]] = []
+
         self.get_metadata(self.lines)
 
         self.get_parts(self.lines)
@@ -219,19 +405,24 @@ class song:
         self.merge_repeating_parts()
         self.merge_consecutive_tab_parts()
 
-    def export(self) -> list[str]:
+    def export(self, lean: bool = False) -> list[str]:
         result = []
+        self.source_map = []
+        self.tab_ranges = []
 
-        result.append(f"% {self.filename}")
-        result.append("")
+        if not lean:
+            result.append(f"% {self.filename}")
+            result.append("")
 
-        for line in self.metadata_src:
-            result.append(f"% {line}")
+            for line in self.metadata_src:
+                result.append(f"% {line}")
 
+        start = len(result)
         result.append("\\begin{song}{")
         for key, value in self.metadata.items():
             result.append(f"{key}={{{self.clean_text(value)}}},")
         result.append("}")
+        self.add_source_map(start, len(result), self.metadata_src)
         result.append("")
 
         # first non-info part to be labelled 'Intro' when it just contains chords
@@ -241,16 +432,75 @@ class song:
 
         # song parts
         for i, part in enumerate(self.song_parts):
-            result.extend(part.export(i == first_non_info, i == last))
+            start = len(result)
+            result.extend(part.export(i == first_non_info, i == last, lean))
+            self.add_source_map(start, len(result), part.chordsheet_src)
+            if isinstance(part, tab_part):
+                self.tab_ranges.append((start, len(result)))
             result.append("")
 
         result.append("\\end{song}")
 
         return result
 
+    def to_ir(self) -> dict:
+        return {
+            "version": ir_version,
+            "filename": self.filename,
+            "metadata": self.metadata,
+            "metadata_src": [line.to_ir() for line in self.metadata_src],
+            "parts": [part.to_ir() for part in self.song_parts],
+        }
+
+    @classmethod
+    def from_ir(cls, data: dict) -> "song":
+        # restore a converted song without parsing it again
+        s = object.__new__(cls)
+        s.filename = data["filename"]
+        s.metadata = data["metadata"]
+        s.metadata_src = [chordsheet_line.from_ir(line) for line in data["metadata_src"]]
+        s.song_parts = [song_part.from_ir(part) for part in data["parts"]]
+        s.source_map = []
+        s.tab_ranges = []
+
+        return s
+
+    def estimate_height(self, metrics: dict) -> float:
+        height = metrics["song_title"]
+
+        for part in self.song_parts:
+            height += metrics["part_skip"] + part.estimate_height(metrics)
+
+        logging.debug("estimated height of '{}': {:.1f}".format(self.filename, height))
+
+        return height
+
+    def add_source_map(self, start: int, end: int, src: list[chordsheet_line]):
+        numbers = [line.number for line in src if isinstance(line, chordsheet_line) and line.number is not None]
+
+        if not numbers:
+            return
+
+        # join consecutive input lines into ranges (1-based, inclusive)
+        ranges = [[numbers[0], numbers[0]]]
+        for number in numbers[1:]:
+            if number == ranges[-1][1] + 1:
+                ranges[-1][1] = number
+            else:
+                ranges.append([number, number])
+
+        self.source_map.append({"output": [start + 1, end], "input": ranges})
+
     def clean_text(self, value: str) -> str:
         return multi_replace(value, pattern_translate_text, translate_text)
 
+    def get_versetypes(self) -> list[str]:
+        # same labelling of chord-only parts as on export
+        first_non_info = next((i for i, part in enumerate(self.song_parts) if part.versetype != "info"), None)
+        last = len(self.song_parts) - 1
+
+        return [part.get_versetype(i == first_non_info, i == last, versetype_default) for i, part in enumerate(self.song_parts)]
+
     def get_metadata(self, lines: list[chordsheet_line]):
         self.get_song_metadata(lines)
         self.add_extended_metadata()
@@ -306,7 +556,7 @@ class song:
             if line.type == "part_header":
                 if part_lines or part_type is not None:
                     if not part_lines:
-                        logging.warning("zero-length part '{}'".format(part_type))
+                        logging.warning("zero-length part '{}' ({}:{})".format(part_type, self.filename, line.number))
 
                     # add previous part
                     self.add_part(part_type, part_src, part_lines, part_rep)
@@ -359,8 +609,8 @@ class song:
 
         else:
             # for loop didn't break = name has no match
-            logging.warning("unknown versetype: {}".format(m.group("name")))
-            part_lines = [chordsheet_line(m.group("all"))]
+            logging.warning("unknown versetype: {} ({}:{})".format(m.group("name"), self.filename, line.number))
+            part_lines = [chordsheet_line(m.group("all"), line.number)]
 
         if m.group("repeat") is not None:
             logging.debug("found repeating part: {} x{}".format(m.group("name"), m.group("repeat")))
@@ -426,18 +676,42 @@ class song_part:
 
         raise NotImplemented
 
+    def to_ir(self) -> dict:
+        return {
+            "type": self.ir_type,
+            "versetype": self.versetype,
+            "rep": self.rep,
+            # merged parts contain plain strings as separators
+            "src": [(line if isinstance(line, chordsheet_line) else chordsheet_line(line)).to_ir() for line in self.chordsheet_src],
+            "lines": [line.to_ir() for line in self.chordsheet_lines],
+            "leadsheet": [line.to_ir() for line in self.leadsheet_lines],
+        }
+
+    @staticmethod
+    def from_ir(data: dict) -> "song_part":
+        # restore the converted part without converting it again
+        part = object.__new__({part_class.ir_type: part_class for part_class in song_part.__subclasses__()}[data["type"]])
+        part.versetype = data["versetype"]
+        part.rep = data["rep"]
+        part.chordsheet_src = [chordsheet_line.from_ir(line) for line in data["src"]]
+        part.chordsheet_lines = [chordsheet_line.from_ir(line) for line in data["lines"]]
+        part.leadsheet_lines = [leadsheet_lines.from_ir(line) for line in data["leadsheet"]]
+
+        return part
+
     def get_versetype(self, is_first: bool, is_last: bool, default: str) -> str:
         if self.versetype is not None:
             return self.versetype
 
         return default
 
-    def export(self, is_first: bool = False, is_last: bool = False) -> list[str]:
+    def export(self, is_first: bool = False, is_last: bool = False, lean: bool = False) -> list[str]:
         verse_type = self.get_versetype(is_first, is_last, versetype_default)
 
         result = []
-        for line in self.chordsheet_src:
-            result.append(f"% {line}")
+        if not lean:
+            for line in self.chordsheet_src:
+                result.append(f"% {line}")
 
         result.append(f"\\begin{{{verse_type}}}")
         result.extend(self.export_lines())
@@ -455,6 +729,10 @@ class song_part:
     def convert(self) -> list[leadsheet_lines]:
         raise NotImplemented
 
+    def estimate_height(self, metrics: dict, line_height: str = "text_line") -> float:
+        # wrapped converted lines, without the breaks added on export
+        return sum(text_rows(text_width(line), metrics) for line in song_part.export_lines(self)) * metrics[line_height]
+
     def format_chord(self, chord: str, text: str = "", trim: bool = False) -> str:
         return "\\chord{}{{{}}}{}".format("*" if trim else "", self.clean_post_chord(chord), self.format_text(text, bar_replace=True))
 
@@ -493,6 +771,8 @@ class song_part:
 
 
 class verse_part(song_part):
+    ir_type = "verse"
+
     def __init__(self, versetype: str, src: list[chordsheet_line], lines: list[chordsheet_line], rep: int = 1):
         super().__init__(versetype, src, lines, rep)
         self.merge_repeating_lines()
@@ -526,6 +806,21 @@ class verse_part(song_part):
 
         return result
 
+    def estimate_height(self, metrics: dict) -> float:
+        lines = [line for leadsheet in self.leadsheet_lines for line in leadsheet.lines]
+        chords = ["\\chord" in line for line in lines]
+
+        if not metrics["versebreak_newline"]:
+            # all lines run together, with room for chords above when there are any
+            rows = text_rows(sum(text_width(line) + 2 for line in lines), metrics)
+            return rows * (metrics["text_line"] + (metrics["chord_line"] if any(chords) else 0))
+
+        height = 0.0
+        for line, chord in zip(lines, chords):
+            height += text_rows(text_width(line), metrics) * (metrics["text_line"] + (metrics["chord_line"] if chord else 0))
+
+        return height
+
     def convert(self) -> list[leadsheet_lines]:
         result = []
 
@@ -636,6 +931,8 @@ class verse_part(song_part):
 
 
 class tab_part(song_part):
+    ir_type = "tab"
+
     def export_lines(self) -> list[str]:
         result = []
 
@@ -657,6 +954,10 @@ class tab_part(song_part):
 
         return "\\makebox[{}{}]{}{{{}}}".format(width_str, tab_cell_unit, alignment_str, text_str)
 
+    def estimate_height(self, metrics: dict) -> float:
+        # tab lines are never wrapped
+        return sum(len(line.lines) for line in self.leadsheet_lines) * metrics["tab_line"]
+
     def convert(self) -> list[leadsheet_lines]:
         result = []
 
@@ -732,9 +1033,14 @@ class tab_part(song_part):
 
 
 class info_part(song_part):
+    ir_type = "info"
+
     def export_lines(self) -> list[str]:
         return self.add_breaks(super().export_lines(), infobreak)
 
+    def estimate_height(self, metrics: dict) -> float:
+        return super().estimate_height(metrics, "info_line")
+
     def convert(self) -> list[leadsheet_lines]:
         result = []
 
@@ -756,40 +1062,519 @@ class info_part(song_part):
         return match.group("description").lower().replace("x", "{--}")
 
 
-def convert_file(filename_input: str, filename_output: str) -> bool:
-    logging.info("converting '{}' to '{}'".format(filename_input, filename_output))
-    lines = read_file(filename_input)
-    if lines:
-        s = song(lines, filename_input)
-        write_file(filename_output, s.export())
-        return True
+class song_stats:
+    def __init__(self):
+        self.names: list[str] = []
+        self.interprets: list[str] = []
+
+        # chord vocabulary (chord -> bit) and the chords of each song as a bit mask
+        self.chord_bits: dict[str, int] = {}
+        self.chord_masks: list[int] = []
+
+        self.song_chords: list[dict[str, int]] = []
+        self.interpret_chords: dict[str, collections.Counter] = collections.defaultdict(collections.Counter)
+        self.chord_songs: collections.Counter = collections.Counter()
+        self.capo: collections.Counter = collections.Counter()
+        self.song_types: collections.Counter = collections.Counter()
+        self.structures: collections.Counter = collections.Counter()
+
+    def add(self, s: song):
+        interpret = s.metadata.get("interpret", "")
+        chords: collections.Counter = collections.Counter()
+        capo: set[str] = set()
+        (tab_lines, text_lines) = (0, 0)
+
+        for part in s.song_parts:
+            for line in part.chordsheet_lines:
+                if isinstance(part, info_part):
+                    if pattern_capo.match(line):
+                        capo.add(line.strip())
+                elif line.type == "chords":
+                    chords.update(
+                        chord
+                        for chord in (self.clean_chord(word) for (word, _, word_is_chord) in line.word_list if word_is_chord)
+                        if not pattern_stats_chord_no.fullmatch(chord)
+                    )
+                elif line.type == "tab":
+                    tab_lines += 1
+                elif line.type == "text":
+                    text_lines += 1
+
+        mask = 0
+        for chord in chords:
+            mask |= 1 << self.chord_bits.setdefault(chord, len(self.chord_bits))
+
+        self.names.append(" - ".join(s.metadata[key] for key in ("interpret", "title") if key in s.metadata) or basename(s.filename))
+        self.interprets.append(interpret)
+        self.chord_masks.append(mask)
+        self.song_chords.append(chords)
+        self.interpret_chords[interpret].update(chords)
+        self.chord_songs.update(chords.keys())
+        self.capo.update(capo)
+        self.structures[" ".join(s.get_versetypes())] += 1
+
+        if tab_lines == 0:
+            self.song_types["lyrics only" if not chords else "chords and lyrics"] += 1
+        elif tab_lines >= text_lines:
+            self.song_types["tab-heavy"] += 1
+        else:
+            self.song_types["tabs and lyrics"] += 1
+
+    def to_ir(self) -> dict:
+        return {
+            "names": self.names,
+            "interprets": self.interprets,
+            "chord_bits": self.chord_bits,
+            "chord_masks": self.chord_masks,
+            "song_chords": self.song_chords,
+            "interpret_chords": self.interpret_chords,
+            "chord_songs": self.chord_songs,
+            "capo": self.capo,
+            "song_types": self.song_types,
+            "structures": self.structures,
+        }
+
+    @classmethod
+    def from_ir(cls, data: dict) -> "song_stats":
+        stats = cls()
+        stats.names = data["names"]
+        stats.interprets = data["interprets"]
+        stats.chord_bits = data["chord_bits"]
+        stats.chord_masks = data["chord_masks"]
+        # only needed for the report, converted when formatted
+        stats.song_chords = data["song_chords"]
+        stats.interpret_chords.update((interpret, collections.Counter(chords)) for interpret, chords in data["interpret_chords"].items())
+        stats.chord_songs = collections.Counter(data["chord_songs"])
+        stats.capo = collections.Counter(data["capo"])
+        stats.song_types = collections.Counter(data["song_types"])
+        stats.structures = collections.Counter(data["structures"])
+
+        return stats
+
+    def clean_chord(self, chord: str) -> str:
+        return multi_replace(pattern_stats_chord_strip.sub("", chord), pattern_translate_chords, translate_chords)
+
+    def playable(self, chords: list[str]) -> list[str]:
+        allowed = 0
+        for chord in chords:
+            if (bit := self.chord_bits.get(self.clean_chord(chord))) is not None:
+                allowed |= 1 << bit
+
+        # songs with chords that don't use any chord outside the given ones
+        return [self.names[i] for i, mask in enumerate(self.chord_masks) if mask and not mask & ~allowed]
+
+    def export(self) -> list[str]:
+        result = []
+
+        result.append("songs: {}".format(len(self.names)))
+        result.append("interprets: {}".format(len(self.interpret_chords)))
+        result.append("chords: {}".format(len(self.chord_bits)))
+
+        result.append("")
+        result.append("# chords (songs)")
+        for chord, count in self.chord_songs.most_common():
+            result.append("{}: {}".format(chord, count))
+
+        result.append("")
+        result.append("# capo / tuning (songs)")
+        for capo, count in self.capo.most_common():
+            result.append("{}: {}".format(capo, count))
+
+        result.append("")
+        result.append("# song types (songs)")
+        for song_type, count in self.song_types.most_common():
+            result.append("{}: {}".format(song_type, count))
+
+        result.append("")
+        result.append("# part structures (songs)")
+        for structure, count in self.structures.most_common():
+            result.append("{}: {}".format(structure, count))
+
+        result.append("")
+        result.append("# chords per interpret (occurrences)")
+        for interpret, chords in sorted(self.interpret_chords.items()):
+            result.append("{}: {}".format(interpret, self.format_chords(chords)))
+
+        result.append("")
+        result.append("# chords per song (occurrences)")
+        for name, chords in zip(self.names, self.song_chords):
+            result.append("{}: {}".format(name, self.format_chords(chords)))
+
+        return result
+
+    def format_chords(self, chords: dict[str, int]) -> str:
+        return ", ".join("{} {}".format(chord, count) for chord, count in collections.Counter(chords).most_common())
+
+
+def pack_songs(heights: list[float], metrics: dict) -> list[tuple[list[int], float]]:
+    page_height = metrics["page_height"]
+
+    # pages (or runs of pages for songs longer than a page) with their songs and the height used on the last page
+    pages: list[tuple[list[int], float]] = []
+
+    # first fit decreasing
+    for i in sorted(range(len(heights)), key=lambda i: heights[i], reverse=True):
+        if heights[i] > page_height:
+            # long songs start on a new page, the space left on their last page can be filled up
+            pages.append(([i], heights[i] - (math.ceil(heights[i] / page_height) - 1) * page_height))
+            continue
+
+        for p, (songs, used) in enumerate(pages):
+            if used + metrics["song_skip"] + heights[i] <= page_height:
+                pages[p] = (songs + [i], used + metrics["song_skip"] + heights[i])
+                break
+        else:
+            pages.append(([i], heights[i]))
+
+    # restore the input order as far as possible, keeping long songs at the start of their pages
+    result = []
+    for songs, used in pages:
+        if heights[songs[0]] > page_height:
+            songs = songs[:1] + sorted(songs[1:])
+        else:
+            songs = sorted(songs)
+        result.append((songs, used))
+
+    return sorted(result, key=lambda page: min(page[0]))
+
+
+def export_song_list(filenames: list[str], pages: list[tuple[list[int], float]] | None = None, include: bool = False) -> list[str]:
+    if include:
+        # \include takes the filename without extension and writes a separate aux file per song
+        return ["\\include{{{}}}".format(str(Path(filename).with_suffix(""))) for filename in filenames]
+
+    if pages is None:
+        return ["\\input{{{}}}".format(filename) for filename in filenames]
+
+    # songs are packed onto pages, so page breaks are set here instead of after each song
+    result = ["\\setleadsheets{after-song={}}"]
+
+    for songs, used in pages:
+        result.append("")
+        result.append("% estimated height of the last page: {:.1f}".format(used))
+        for i in songs:
+            result.append("\\input{{{}}}".format(filenames[i]))
+        result.append("\\clearpage")
+
+    return result
+
+
+def export_includeonly(filenames: list[str]) -> list[str]:
+    # songs that haven't been typeset since their last change (aux file missing or older)
+    outdated = []
+    for filename in filenames:
+        aux = Path(filename).with_suffix(".aux")
+        if not aux.exists() or aux.stat().st_mtime < Path(filename).stat().st_mtime:
+            outdated.append(str(Path(filename).with_suffix("")))
+
+    if not outdated or len(outdated) == len(filenames):
+        logging.info("including all {} songs".format(len(filenames)))
+        return ["% all songs are included"]
+
+    logging.info("including {} of {} songs".format(len(outdated), len(filenames)))
+    return ["\\includeonly{{{}}}".format(",".join(outdated))]
+
+
+def include_name(name: str) -> str:
+    # \include and \includeonly don't cope with spaces, commas or TeX special characters in filenames (letters like 'ä' are kept)
+    return pattern_include_name.sub("_", name)
+
+
+def load_layout_metrics(filename: str | None) -> dict:
+    metrics = layout_metrics.copy()
+
+    if filename is not None:
+        with open(filename, "r") as file:
+            for key, value in json.load(file).items():
+                if key not in metrics:
+                    logging.warning("unknown layout metric: {}".format(key))
+                metrics[key] = value
+
+    return metrics
+
+
+def convert_file(filename_input: str, filenames_output: dict[int, str], lean: bool = False, cache: str | None = None) -> song | None:
+    logging.info("converting '{}'".format(filename_input))
+    if s := load_song(filename_input, cache):
+        # parse and convert once, then write one output per transposition
+        exported = s.export(lean)
+
+        for semitones, filename_output in filenames_output.items():
+            logging.info("writing '{}'".format(filename_output))
+            write_file(filename_output, transpose_lines(exported, semitones, s.tab_ranges))
+
+            if s.tab_ranges and semitones % 12 != 0:
+                logging.warning("tab parts of '{}' are kept in the original key".format(filename_input))
+
+            if lean:
+                # transposition keeps the line layout, so the same map applies to every output
+                write_source_map(filename_output, filename_input, s.source_map)
+            else:
+                # a map left over from an earlier lean run doesn't match the output anymore
+                Path(f"{filename_output}.map").unlink(missing_ok=True)
+
+        return s
     else:
-        logging.error("empty file: '{}'".format(filename_input))
-        return False
+        return None
+
+
+def load_song(filename: str, cache: str | None = None) -> song | None:
+    if cache is not None:
+        # converted songs depend on the conversion settings as well as on the input
+        settings = json.dumps(ir_settings, ensure_ascii=False)
+
+        with open(filename, "rb") as file:
+            key = hashlib.sha256(f"{ir_version}:{settings}:".encode() + file.read()).hexdigest()
+
+        # one entry per input file, replaced when the input or the settings change
+        filename_ir = Path(cache) / "{}.json".format(hashlib.sha256(filename.encode()).hexdigest())
+
+        if filename_ir.exists():
+            try:
+                if s := read_ir(filename_ir, key):
+                    logging.debug("loading '{}' from '{}'".format(filename, filename_ir))
+                    return s
+                logging.debug("outdated '{}', converting '{}' again".format(filename_ir, filename))
+            except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                # damaged or outdated entry (e.g. interrupted write), convert again and replace it
+                logging.warning("can't load '{}', converting '{}' again: {}".format(filename_ir, filename, e))
+
+    lines = read_file(filename)
+    if not lines:
+        logging.error("empty file: '{}'".format(filename))
+        return None
+
+    s = song(lines, filename)
+
+    if cache is not None:
+        write_ir(filename_ir, s, key)
+
+    return s
+
+
+def read_ir(filename: str | Path, key: str | None = None) -> song | None:
+    with open(filename, "r", encoding="utf-8") as file:
+        data = json.load(file)
+
+    if data.get("version") != ir_version:
+        raise ValueError("unsupported IR version {} in '{}'".format(data.get("version"), filename))
+
+    # converted from a different input or with different settings
+    if key is not None and data.get("key") != key:
+        return None
+
+    return song.from_ir(data)
+
+
+def write_ir(filename: str | Path, s: song, key: str | None = None):
+    data = s.to_ir()
+    if key is not None:
+        data["key"] = key
+
+    write_json(filename, data)
+
+
+def write_json(filename: str | Path, data: dict):
+    path = Path(filename)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # write to a temporary file first, so an interrupted write doesn't leave a damaged file
+    path_tmp = path.with_name(f"{path.name}.tmp")
+
+    with open(path_tmp, "w", encoding="utf-8") as file:
+        json.dump(data, file, ensure_ascii=False, separators=(",", ":"))
+
+    path_tmp.replace(path)
 
 
 def read_file(filename: str) -> list[chordsheet_line]:
     with open(filename, "r") as file:
         lines = file.readlines()
 
-    return [chordsheet_line(line.rstrip()) for line in lines]
+    return [chordsheet_line(line.rstrip(), number) for number, line in enumerate(lines, start=1)]
 
 
 def write_file(filename: str, lines: list[str]):
-    with open(filename, "w") as file:
-        file.writelines((f"{line}\n" for line in lines))
+    path = Path(filename)
+    content = "".join(f"{line}\n" for line in lines)
 
+    # keep unchanged files (and their modification time) as they are
+    if path.exists() and path.read_text() == content:
+        logging.debug("unchanged: '{}'".format(filename))
+        return
 
-def main():
-    song_list = []
+    path.parent.mkdir(parents=True, exist_ok=True)
 
-    for filename_input in sys.argv[1:]:
-        filename_output = "songs/{}.tex".format(basename(filename_input))
+    with open(filename, "w") as file:
+        file.write(content)
+
+
+def write_source_map(filename: str, filename_input: str, source_map: list[dict[str, list]]):
+    with open(f"{filename}.map", "w") as file:
+        json.dump({"input": filename_input, "output": filename, "map": source_map}, file, separators=(",", ":"))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Convert text based chord sheets to LaTeX")
+    parser.add_argument("files", metavar="FILE", nargs="+", help="chord sheet input file")
+    parser.add_argument(
+        "-t",
+        "--transpose",
+        metavar="SEMITONES",
+        type=int,
+        action="append",
+        help="write a transposed copy of every song to 'songs/<SEMITONES>/' and list them in 'songs<SEMITONES>.tex' (can be given multiple times)",
+    )
+    parser.add_argument(
+        "-l",
+        "--lean",
+        action="store_true",
+        help="don't echo the input lines as comments, write a source map next to each output file ('songs/<name>.tex.map') instead",
+    )
+    parser.add_argument(
+        "-p",
+        "--pack",
+        action="store_true",
+        help="reorder the songs to fill up pages, based on their estimated height, and set the page breaks in 'songs.tex'",
+    )
+    parser.add_argument(
+        "--layout-metrics",
+        metavar="FILE",
+        help="JSON file with layout metrics to calibrate the height estimation",
+    )
+    parser.add_argument(
+        "-i",
+        "--include",
+        action="store_true",
+        help="use \\include in 'songs.tex' and write 'songs-includeonly.tex' listing the songs that changed since they were last typeset",
+    )
+
+    parser.add_argument(
+        "-c",
+        "--cache",
+        metavar="DIR",
+        help="cache the converted songs in DIR, so unchanged input files aren't parsed again",
+    )
+
+    parser.add_argument(
+        "-s",
+        "--stats",
+        action="store_true",
+        help="print chord, capo, song type and part structure statistics instead of converting",
+    )
+    parser.add_argument(
+        "--playable",
+        metavar="CHORDS",
+        help="print the songs using only the given chords (comma separated) instead of converting",
+    )
+
+    args = parser.parse_args()
+
+    if args.include and args.pack:
+        parser.error("--include can't be combined with --pack (\\include starts a new page for each song)")
+
+    if args.layout_metrics is not None and not args.pack:
+        parser.error("--layout-metrics requires --pack")
+
+    return args
+
+
+def load_stats(filenames: list[str], cache: str | None = None) -> song_stats:
+    if cache is not None:
+        # the statistics are kept as long as the same input files are unchanged (size and modification time)
+        key = hashlib.sha256(f"{ir_version}:{stats_version}:{json.dumps(ir_settings, ensure_ascii=False)}".encode())
+        # os.stat instead of Path.stat, as creating the paths takes longer than the stat calls for large libraries
+        for filename in filenames:
+            stat = os.stat(filename)
+            key.update(f":{filename}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+
+        filename_stats = Path(cache) / "stats.json"
+
+        if filename_stats.exists():
+            try:
+                with open(filename_stats, "r", encoding="utf-8") as file:
+                    data = json.load(file)
+
+                if data["key"] == key.hexdigest():
+                    logging.debug("loading statistics from '{}'".format(filename_stats))
+                    return song_stats.from_ir(data["stats"])
+            except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                logging.warning("can't load '{}', collecting statistics again: {}".format(filename_stats, e))
+
+    stats = song_stats()
+
+    for filename in filenames:
+        if s := load_song(filename, cache):
+            stats.add(s)
+
+    if cache is not None:
+        write_json(filename_stats, {"key": key.hexdigest(), "stats": stats.to_ir()})
+
+    return stats
+
+
+def print_stats(filenames: list[str], cache: str | None = None, playable: str | None = None):
+    stats = load_stats(filenames, cache)
+
+    if playable is not None:
+        result = stats.playable([chord.strip() for chord in playable.split(",")])
+    else:
+        result = stats.export()
+
+    for line in result:
+        print(line)
 
-        if convert_file(filename_input, filename_output):
-            song_list.append("\\input{{{}}}".format(filename_output))
 
-    write_file("songs.tex", song_list)
+def main():
+    args = parse_args()
+
+    if args.stats or args.playable is not None:
+        # keep the output readable (and pipeable) without the conversion log
+        logging.getLogger().setLevel(logging.WARNING)
+        print_stats(args.files, args.cache, args.playable)
+        return
+
+    if args.transpose:
+        # e.g. 'songs/+2/interpret - title.tex' listed in 'songs+2.tex'
+        prefixes = {semitones: "songs{}".format(transposition_label(semitones)) for semitones in args.transpose}
+        directories = {semitones: "songs/{}".format(transposition_label(semitones)) for semitones in args.transpose}
+    else:
+        prefixes = {0: "songs"}
+        directories = {0: "songs"}
+
+    songs: list[song] = []
+    song_lists: dict[int, list[str]] = {semitones: [] for semitones in prefixes}
+    names: set[str] = set()
+
+    for filename_input in args.files:
+        name = include_name(basename(filename_input)) if args.include else basename(filename_input)
+
+        # input files from different folders (or names only differing in replaced characters) would overwrite each other
+        if name in names:
+            unique = next("{}_{}".format(name, i) for i in range(2, len(names) + 2) if "{}_{}".format(name, i) not in names)
+            logging.warning("output name '{}' of '{}' is already used, writing to '{}'".format(name, filename_input, unique))
+            name = unique
+        names.add(name)
+
+        filenames_output = {semitones: "{}/{}.tex".format(directory, name) for semitones, directory in directories.items()}
+
+        if s := convert_file(filename_input, filenames_output, args.lean, args.cache):
+            songs.append(s)
+            for semitones, filename_output in filenames_output.items():
+                song_lists[semitones].append(filename_output)
+
+    pages = None
+    if args.pack:
+        metrics = load_layout_metrics(args.layout_metrics)
+        heights = [s.estimate_height(metrics) for s in songs]
+        pages = pack_songs(heights, metrics)
+        logging.info("packed {} songs onto {} pages".format(len(songs), sum(math.ceil(heights[p[0]] / metrics["page_height"]) for p, _ in pages)))
+
+    for semitones, prefix in prefixes.items():
+        write_file("{}.tex".format(prefix), export_song_list(song_lists[semitones], pages, args.include))
+
+        if args.include:
+            write_file("{}-includeonly.tex".format(prefix), export_includeonly(song_lists[semitones]))
 
 
 if __name__ == "__main__":